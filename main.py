@@ -12,7 +12,8 @@ MAX_RETRIES = 5
 def load_from_args():
     if len(sys.argv) not in (6, 7, 8):
         print("Usage: python main.py <帳號> <起站> <終站> <日期> <車次> [座位偏好(n/a/w)] [目標車廂]")
-        print("       python main.py query <起站> <終站> <日期> <時間(HH:MM)>")
+        print("       python main.py query <起站> <終站> <日期> <時間(HH:MM)> [--format table|json|ndjson|csv] [--all]")
+        print("       python main.py range <起站> <終站> <起日> <迄日> <起時間> <迄時間> [--type 車種,...] [--sort duration|arrival] [--top N] [--format F]")
         print("  日期格式：YYYYMMDD / MMDD / DD（未填年月自動補當前）")
         sys.exit(EXIT_ERROR)
 
@@ -43,6 +44,18 @@ def load_from_args():
     }
     return data
 
+def pop_option(args, name, default=None):
+    """Remove `name value` from args and return value (default if absent)."""
+    if name not in args:
+        return default
+    i = args.index(name)
+    if i + 1 >= len(args):
+        print(f"錯誤：{name} 需要指定值", file=sys.stderr)
+        sys.exit(EXIT_ERROR)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
 class Booker():
     def __init__(self):
         self.cfg = load_from_args()
@@ -146,18 +159,41 @@ class Booker():
             self.driver.quit()
 
 if __name__ == "__main__":
-    # query subcommand: python main.py query <起站> <日期> <時間> [終站]
+    # query subcommand: python main.py query <起站> <終站> <日期> [時間] [--format F] [--all]
     if len(sys.argv) >= 2 and sys.argv[1] == "query":
-        if len(sys.argv) != 6:
-            print("Usage: python main.py query <起站> <終站> <日期> <時間(HH:MM)>")
-            print("  日期格式：YYYYMMDD / MMDD / DD（未填年月自動補當前）")
+        args = sys.argv[2:]
+        fmt = pop_option(args, "--format", "table")
+        all_trains = "--all" in args
+        if all_trains:
+            args.remove("--all")
+        if len(args) != (3 if all_trains else 4):
+            print("Usage: python main.py query <起站> <終站> <日期> <時間(HH:MM)> [--format table|json|ndjson|csv]", file=sys.stderr)
+            print("       python main.py query <起站> <終站> <日期> --all [--format table|json|ndjson|csv]", file=sys.stderr)
+            print("       python main.py range <起站> <終站> <起日> <迄日> <起時間> <迄時間> [選項]", file=sys.stderr)
+            print("  日期格式：YYYYMMDD / MMDD / DD（未填年月自動補當前）", file=sys.stderr)
             sys.exit(EXIT_ERROR)
         from tdx import query_trains
-        origin = sys.argv[2]
-        dest = sys.argv[3]
-        date = sys.argv[4]
-        time_s = sys.argv[5]
-        query_trains(date, time_s, origin, dest)
+        origin, dest, date = args[:3]
+        time_s = None if all_trains else args[3]
+        query_trains(date, time_s, origin, dest, fmt=fmt, all_trains=all_trains)
+        sys.exit(EXIT_SUCCESS)
+
+    # range subcommand: python main.py range <起站> <終站> <起日> <迄日> <起時間> <迄時間> [選項]
+    if len(sys.argv) >= 2 and sys.argv[1] == "range":
+        args = sys.argv[2:]
+        fmt = pop_option(args, "--format", "table")
+        sort = pop_option(args, "--sort", "duration")
+        types = pop_option(args, "--type")
+        top = pop_option(args, "--top", "3")
+        if len(args) != 6 or not top.isdigit() or int(top) < 1:
+            print("Usage: python main.py range <起站> <終站> <起日> <迄日> <起時間> <迄時間>"
+                  " [--type 車種,...] [--sort duration|arrival] [--top N] [--format table|json|ndjson|csv]", file=sys.stderr)
+            print("  日期格式：YYYYMMDD / MMDD / DD（未填年月自動補當前）", file=sys.stderr)
+            sys.exit(EXIT_ERROR)
+        from tdx import query_range
+        origin, dest, start, end, time_from, time_to = args
+        query_range(start, end, time_from, time_to, origin, dest,
+                    types=types.split(",") if types else None, sort=sort, top=int(top), fmt=fmt)
         sys.exit(EXIT_SUCCESS)
 
     # schedule subcommand: python main.py schedule <間隔秒數> <帳號> <起站> ...
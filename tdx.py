@@ -1,12 +1,19 @@
+import csv
+import json
 import os
 import re
 import sys
+import threading
+import time
 import requests
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from stations import stationIDs
 
 TDX_AUTH_URL = "https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token"
 TDX_BASE_URL = "https://tdx.transportdata.tw/api/basic"
+TDX_MAX_RETRIES = 3  # extra attempts on 429 / 5xx
+TDX_RETRY_BACKOFF = 1.0  # seconds, doubled on each retry
 
 # Map station name (Chinese) to TDX StationID
 # TDX uses the same numeric IDs as stations.py
@@ -24,6 +31,20 @@ TRAIN_TYPE_NAMES = {
     "11": "區間快",
 }
 
+OUTPUT_FORMATS = ("table", "json", "ndjson", "csv")
+
+# Stable field names for machine-readable output (json / ndjson / csv)
+RECORD_FIELDS = ("train_no", "train_type", "departure", "arrival", "duration_min")
+# 'error' is only set on the single record emitted for a day that failed
+RANGE_RECORD_FIELDS = ("date", "rank") + RECORD_FIELDS + ("error",)
+
+RANGE_SORT_KEYS = ("duration", "arrival")
+RANGE_MAX_WORKERS = 5  # TDX 免費方案有速率限制，不宜同時發太多請求
+
+# Daily timetables are cached on disk so repeated range searches skip the API
+TIMETABLE_CACHE_DIR = ".tdx_cache"
+TIMETABLE_CACHE_TTL = 6 * 60 * 60  # seconds
+
 
 def parse_date(s):
     """
@@ -99,14 +120,19 @@ def _tdx_get(token, path, params=None):
     if params is None:
         params = {}
     params.setdefault("$format", "JSON")
-    resp = requests.get(
-        f"{TDX_BASE_URL}{path}",
-        headers=headers,
-        params=params,
-        timeout=15,
-    )
-    resp.raise_for_status()
-    return resp.json()
+    for attempt in range(TDX_MAX_RETRIES + 1):
+        resp = requests.get(
+            f"{TDX_BASE_URL}{path}",
+            headers=headers,
+            params=params,
+            timeout=15,
+        )
+        if attempt < TDX_MAX_RETRIES and (resp.status_code == 429 or resp.status_code >= 500):
+            retry_after = resp.headers.get("Retry-After", "")
+            time.sleep(float(retry_after) if retry_after.isdigit() else TDX_RETRY_BACKOFF * 2 ** attempt)
+            continue
+        resp.raise_for_status()
+        return resp.json()
 
 
 def _short_type_name(name):
@@ -127,117 +153,266 @@ def _time_diff_minutes(target_hhmm, train_hhmm):
     return (r_h * 60 + r_m) - (t_h * 60 + t_m)
 
 
-def _format_duration(dep_str, arr_str):
-    """Return human-readable duration like '1時09分'."""
+def _duration_minutes(dep_str, arr_str):
+    """Return travel time in minutes, wrapping past midnight."""
     d_h, d_m = _parse_hhmm(dep_str)
     a_h, a_m = _parse_hhmm(arr_str)
     total = (a_h * 60 + a_m) - (d_h * 60 + d_m)
     if total < 0:
         total += 24 * 60
-    h, m = divmod(total, 60)
+    return total
+
+
+def _format_duration(dep_str, arr_str):
+    """Return human-readable duration like '1時09分'."""
+    h, m = divmod(_duration_minutes(dep_str, arr_str), 60)
     if h:
         return f"{h}時{m:02d}分"
     return f"{m}分"
 
 
-def query_trains(date_str, time_str, origin_name, dest_name, nearby=5):
+def _type_display(t):
+    return _short_type_name(t["type_name"]) or TRAIN_TYPE_NAMES.get(t["type_id"], t["type_id"])
+
+
+def _parse_train(item, origin_id, dest_id):
+    """Parse one timetable entry; return None if it does not depart from origin."""
+    info = item.get("TrainInfo") or {}
+    stops = item.get("StopTimes") or []
+    dep_stop = next((s for s in stops if s.get("StationID") == origin_id), None)
+    arr_stop = next((s for s in stops if s.get("StationID") == dest_id), None)
+    if not dep_stop:
+        return None
+    dep_time = dep_stop.get("DepartureTime", dep_stop.get("ArrivalTime", ""))
+    arr_time = arr_stop.get("ArrivalTime", arr_stop.get("DepartureTime", "")) if arr_stop else ""
+    if not dep_time:
+        return None
+    # Validate early so sorting / formatting never sees a bad time
+    _parse_hhmm(dep_time)
+    if arr_time:
+        _parse_hhmm(arr_time)
+    return {
+        "train_no": info.get("TrainNo", ""),
+        "type_id": str(info.get("TrainTypeCode", info.get("TrainTypeID", ""))),
+        "type_name": (info.get("TrainTypeName") or {}).get("Zh_tw", ""),
+        "dep_time": dep_time,
+        "arr_time": arr_time,
+    }
+
+
+def _iter_trains(data, origin_id, dest_id):
+    """Yield one train dict per timetable entry that departs from origin.
+
+    Malformed entries are skipped with a warning on stderr.
+    """
+    if isinstance(data, dict):
+        data = next((v for v in data.values() if isinstance(v, list)), [])
+    # Response: list of { TrainInfo: {...}, StopTimes: [...] }
+    for item in data:
+        try:
+            train = _parse_train(item, origin_id, dest_id)
+        except (AttributeError, TypeError, ValueError, IndexError) as e:
+            print(f"略過無法解析的班次資料: {e!r}", file=sys.stderr)
+            continue
+        if train:
+            yield train
+
+
+def _to_record(t):
+    """Convert a train dict into a record with the stable RECORD_FIELDS names."""
+    dep = t["dep_time"][:5]
+    arr = t["arr_time"][:5] if t["arr_time"] else ""
+    return {
+        "train_no": t["train_no"],
+        "train_type": _type_display(t),
+        "departure": dep,
+        "arrival": arr,
+        "duration_min": _duration_minutes(dep, arr) if arr else None,
+    }
+
+
+def _table_row(t, marker=""):
+    dep = t["dep_time"][:5] if t["dep_time"] else "─"
+    arr = t["arr_time"][:5] if t["arr_time"] else "─"
+    duration = _format_duration(dep, arr) if t["dep_time"] and t["arr_time"] else "─"
+    return f"{t['train_no']:<6} {_type_display(t):<12} {dep:<7} {arr:<7} {duration}{marker}"
+
+
+def _print_table_header(prefix=""):
+    print(f"{prefix}{'車次':<6} {'車種':<12} {'出發':<7} {'到達':<7} {'行駛時間'}")
+    print("─" * (52 + len(prefix)))
+
+
+def write_records(records, fmt, out=None, fields=RECORD_FIELDS):
+    """
+    將 records（dict 的 iterable）依 fmt 逐筆寫出，不先收集成 list。
+
+    fmt: 'json'（單一陣列）/ 'ndjson'（每行一筆）/ 'csv'（含標頭）
+    """
+    if out is None:
+        out = sys.stdout
+    if fmt == "ndjson":
+        for r in records:
+            out.write(json.dumps(r, ensure_ascii=False) + "\n")
+    elif fmt == "json":
+        out.write("[")
+        try:
+            for i, r in enumerate(records):
+                out.write(("," if i else "") + "\n  " + json.dumps(r, ensure_ascii=False))
+        finally:
+            # Keep the array well-formed even if records raises midway
+            out.write("\n]\n")
+    elif fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=fields, lineterminator="\n")
+        writer.writeheader()
+        for r in records:
+            writer.writerow(r)
+    else:
+        raise ValueError(f"不支援的輸出格式：{fmt!r}")
+
+
+def _station_id(name, label):
+    if name not in _STATION_NAME_TO_ID:
+        print(f"錯誤：{label} '{name}' 不存在", file=sys.stderr)
+        sys.exit(1)
+    return _STATION_NAME_TO_ID[name]
+
+
+def _request_token():
+    """Load tdx_config and return an access token, raising RuntimeError on failure."""
+    cfg = _load_config()
+    client_id = cfg.get("client_id", "")
+    client_secret = cfg.get("client_secret", "")
+    if not client_id or not client_secret:
+        raise RuntimeError(
+            "請在 tdx_config 設定 client_id 和 client_secret\n"
+            "  前往 https://tdx.transportdata.tw 免費註冊"
+        )
+    try:
+        return _get_token(client_id, client_secret)
+    except Exception as e:
+        raise RuntimeError(f"TDX 認證失敗: {e}") from e
+
+
+def _login():
+    """Like _request_token, but print the error and exit."""
+    try:
+        return _request_token()
+    except RuntimeError as e:
+        print(f"錯誤：{e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _fetch_timetable(token, origin_id, dest_id, api_date):
+    return _tdx_get(
+        token,
+        f"/v3/Rail/TRA/DailyTrainTimetable/OD/{origin_id}/to/{dest_id}/{api_date}",
+    )
+
+
+def _cached_timetable(get_token, origin_id, dest_id, api_date, cache_dir=TIMETABLE_CACHE_DIR):
+    """
+    Return the OD timetable, reading from / writing to the on-disk cache.
+
+    get_token is only called on a cache miss, so a fully cached lookup
+    needs neither credentials nor network.
+    """
+    path = os.path.join(cache_dir, f"{origin_id}_{dest_id}_{api_date}.json")
+    try:
+        if time.time() - os.path.getmtime(path) < TIMETABLE_CACHE_TTL:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    data = _fetch_timetable(get_token(), origin_id, dest_id, api_date)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        pass  # cache is best-effort
+    return data
+
+
+def query_trains(date_str, time_str, origin_name, dest_name, nearby=5, fmt="table", all_trains=False):
     """
     查詢指定日期/時間/起站→終站附近的台鐵班次。
 
     Args:
         date_str: 接受 YYYYMMDD / MMDD / DD，年月未填自動補當前
-        time_str: 'HH:MM'
+        time_str: 'HH:MM'（all_trains 時可為 None）
         origin_name: 起站中文名稱
         dest_name: 終站中文名稱
         nearby: 時間前後各幾班
+        fmt: 'table' / 'json' / 'ndjson' / 'csv'
+        all_trains: 列出整天所有班次（忽略 time_str 與 nearby），
+            依 API 回傳順序邊解析邊輸出
 
     Returns:
-        None（直接印出）
+        None（直接寫到 stdout；錯誤訊息寫到 stderr）
     """
+    if fmt not in OUTPUT_FORMATS:
+        print(f"錯誤：不支援的輸出格式 {fmt!r}（可用：{', '.join(OUTPUT_FORMATS)}）", file=sys.stderr)
+        sys.exit(1)
+
     # Parse and normalise date / time
     try:
         date8 = parse_date(date_str)  # YYYYMMDD
+        if not all_trains:
+            time_str = parse_time(time_str)  # HH:MM
     except ValueError as e:
-        print(f"錯誤：{e}")
-        sys.exit(1)
-    try:
-        time_str = parse_time(time_str)  # HH:MM
-    except ValueError as e:
-        print(f"錯誤：{e}")
+        print(f"錯誤：{e}", file=sys.stderr)
         sys.exit(1)
     # TDX API requires YYYY-MM-DD
     api_date = f"{date8[:4]}-{date8[4:6]}-{date8[6:]}"
     display_date = f"{date8[:4]}/{date8[4:6]}/{date8[6:]}"
 
-    # Validate stations
-    if origin_name not in _STATION_NAME_TO_ID:
-        print(f"錯誤：起站 '{origin_name}' 不存在")
-        sys.exit(1)
-    if dest_name not in _STATION_NAME_TO_ID:
-        print(f"錯誤：終站 '{dest_name}' 不存在")
-        sys.exit(1)
-
-    origin_id = _STATION_NAME_TO_ID[origin_name]
-    dest_id = _STATION_NAME_TO_ID[dest_name]
+    origin_id = _station_id(origin_name, "起站")
+    dest_id = _station_id(dest_name, "終站")
 
-    # Load credentials
-    cfg = _load_config()
-    client_id = cfg.get("client_id", "")
-    client_secret = cfg.get("client_secret", "")
-    if not client_id or not client_secret:
-        print("錯誤：請在 tdx_config 設定 client_id 和 client_secret")
-        print("  前往 https://tdx.transportdata.tw 免費註冊")
-        sys.exit(1)
+    token = _login()
 
     try:
-        token = _get_token(client_id, client_secret)
-    except Exception as e:
-        print(f"TDX 認證失敗: {e}")
-        sys.exit(1)
-
-    target_hhmm = _parse_hhmm(time_str)
-    trains = []
-
-    try:
-        data = _tdx_get(
-            token,
-            f"/v3/Rail/TRA/DailyTrainTimetable/OD/{origin_id}/to/{dest_id}/{api_date}",
-        )
-        if isinstance(data, dict):
-            data = next((v for v in data.values() if isinstance(v, list)), [])
-        # Response: list of { TrainInfo: {...}, StopTimes: [...] }
-        for item in data:
-            info = item.get("TrainInfo", {})
-            stops = item.get("StopTimes", [])
-            dep_stop = next((s for s in stops if s["StationID"] == origin_id), None)
-            arr_stop = next((s for s in stops if s["StationID"] == dest_id), None)
-            if not dep_stop:
-                continue
-            dep_time = dep_stop.get("DepartureTime", dep_stop.get("ArrivalTime", ""))
-            arr_time = arr_stop.get("ArrivalTime", arr_stop.get("DepartureTime", "")) if arr_stop else ""
-            trains.append({
-                "train_no": info.get("TrainNo", ""),
-                "type_id": str(info.get("TrainTypeCode", info.get("TrainTypeID", ""))),
-                "type_name": info.get("TrainTypeName", {}).get("Zh_tw", ""),
-                "dep_time": dep_time,
-                "arr_time": arr_time,
-            })
+        data = _fetch_timetable(token, origin_id, dest_id, api_date)
     except requests.HTTPError as e:
-        print(f"TDX API 錯誤: {e}")
+        print(f"TDX API 錯誤: {e}", file=sys.stderr)
         sys.exit(1)
     except Exception as e:
-        print(f"查詢失敗: {e}")
+        print(f"查詢失敗: {e}", file=sys.stderr)
         sys.exit(1)
 
-    if not trains:
-        print("查無資料")
+    if all_trains:
+        trains = _iter_trains(data, origin_id, dest_id)
+        if fmt != "table":
+            write_records(map(_to_record, trains), fmt)
+            return
+        count = 0
+        for t in trains:
+            if not count:
+                print(f"\n查詢: {origin_name} → {dest_name} | {display_date} 全日班次\n")
+                _print_table_header()
+            print(_table_row(t))
+            count += 1
+        if count:
+            print()
+        else:
+            print("查無資料")
         return
 
     # Sort by departure time
-    trains = [t for t in trains if t["dep_time"]]
-    trains.sort(key=lambda t: _parse_hhmm(t["dep_time"]))
+    trains = sorted(_iter_trains(data, origin_id, dest_id), key=lambda t: _parse_hhmm(t["dep_time"]))
+
+    if not trains:
+        if fmt == "table":
+            print("查無資料")
+        else:
+            write_records([], fmt)
+        return
 
     # Find closest train index
+    target_hhmm = _parse_hhmm(time_str)
     diffs = [abs(_time_diff_minutes(target_hhmm, _parse_hhmm(t["dep_time"]))) for t in trains]
     closest_idx = diffs.index(min(diffs))
 
@@ -245,19 +420,164 @@ def query_trains(date_str, time_str, origin_name, dest_name, nearby=5):
     hi = min(len(trains), closest_idx + nearby + 1)
     selected = trains[lo:hi]
 
+    if fmt != "table":
+        write_records(map(_to_record, selected), fmt)
+        return
+
     # Print header
     print(f"\n查詢: {origin_name} → {dest_name} | {display_date} {time_str} 附近班次\n")
 
-    header = f"{'車次':<6} {'車種':<12} {'出發':<7} {'到達':<7} {'行駛時間'}"
-    sep = "─" * 52
-    print(header)
-    print(sep)
+    _print_table_header()
     for t in selected:
-        type_display = _short_type_name(t["type_name"]) or TRAIN_TYPE_NAMES.get(t["type_id"], t["type_id"])
-        dep = t["dep_time"][:5] if t["dep_time"] else "─"
-        arr = t["arr_time"][:5] if t["arr_time"] else "─"
-        duration = _format_duration(dep, arr) if t["dep_time"] and t["arr_time"] else "─"
-        marker = " ←" if t == trains[closest_idx] else ""
-        print(f"{t['train_no']:<6} {type_display:<12} {dep:<7} {arr:<7} {duration}{marker}")
+        marker = " ←" if t is trains[closest_idx] else ""
+        print(_table_row(t, marker))
 
     print()
+
+
+def _date_range(start8, end8):
+    """Yield YYYYMMDD strings from start8 to end8 inclusive."""
+    day = datetime.strptime(start8, "%Y%m%d")
+    end = datetime.strptime(end8, "%Y%m%d")
+    while day <= end:
+        yield day.strftime("%Y%m%d")
+        day += timedelta(days=1)
+
+
+def _best_trains(data, origin_id, dest_id, lo, hi, types, sort, top):
+    """Pick the top trains departing within [lo, hi] minutes, ranked by sort."""
+    candidates = []
+    for t in _iter_trains(data, origin_id, dest_id):
+        if not t["arr_time"]:
+            continue
+        if types and TRAIN_TYPE_NAMES.get(t["type_id"]) not in types:
+            continue
+        d_h, d_m = _parse_hhmm(t["dep_time"])
+        dep_min = d_h * 60 + d_m
+        if not lo <= dep_min <= hi:
+            continue
+        duration = _duration_minutes(t["dep_time"], t["arr_time"])
+        key = (duration, dep_min) if sort == "duration" else (dep_min + duration, duration)
+        candidates.append((key, t))
+    candidates.sort(key=lambda c: c[0])
+    return [t for _, t in candidates[:top]]
+
+
+def query_range(start_date, end_date, time_from, time_to, origin_name, dest_name,
+                types=None, sort="duration", top=3, fmt="table"):
+    """
+    查詢日期區間內每天指定出發時段的最佳班次。
+
+    每天的時刻表以多執行緒同時抓取，並快取於 TIMETABLE_CACHE_DIR。
+
+    Args:
+        start_date / end_date: 接受 YYYYMMDD / MMDD / DD，含頭尾
+        time_from / time_to: 出發時段，格式同 parse_time
+        origin_name: 起站中文名稱
+        dest_name: 終站中文名稱
+        types: 車種篩選（TRAIN_TYPE_NAMES 的名稱），None 表示不限
+        sort: 'duration'（行駛最快）或 'arrival'（最早抵達）
+        top: 每天取前幾班
+        fmt: 'table' / 'json' / 'ndjson' / 'csv'
+
+    Returns:
+        None（直接寫到 stdout；錯誤訊息寫到 stderr）
+    """
+    if fmt not in OUTPUT_FORMATS:
+        print(f"錯誤：不支援的輸出格式 {fmt!r}（可用：{', '.join(OUTPUT_FORMATS)}）", file=sys.stderr)
+        sys.exit(1)
+    if sort not in RANGE_SORT_KEYS:
+        print(f"錯誤：不支援的排序方式 {sort!r}（可用：{', '.join(RANGE_SORT_KEYS)}）", file=sys.stderr)
+        sys.exit(1)
+    types = set(types or ())
+    unknown = types - set(TRAIN_TYPE_NAMES.values())
+    if unknown:
+        print(f"錯誤：未知的車種 {', '.join(sorted(unknown))}（可用：{', '.join(TRAIN_TYPE_NAMES.values())}）", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        start8 = parse_date(start_date)
+        end8 = parse_date(end_date)
+        time_from = parse_time(time_from)
+        time_to = parse_time(time_to)
+        dates = list(_date_range(start8, end8))
+    except ValueError as e:
+        print(f"錯誤：{e}", file=sys.stderr)
+        sys.exit(1)
+    if not dates:
+        print("錯誤：起日晚於迄日", file=sys.stderr)
+        sys.exit(1)
+    if time_from > time_to:
+        print("錯誤：起始時間晚於結束時間", file=sys.stderr)
+        sys.exit(1)
+    f_h, f_m = _parse_hhmm(time_from)
+    t_h, t_m = _parse_hhmm(time_to)
+    lo, hi = f_h * 60 + f_m, t_h * 60 + t_m
+
+    origin_id = _station_id(origin_name, "起站")
+    dest_id = _station_id(dest_name, "終站")
+
+    token_lock = threading.Lock()
+    token_state = {}
+
+    def get_token():
+        # Authenticate once, on the first cache miss; remember failures too
+        with token_lock:
+            if not token_state:
+                try:
+                    token_state["token"] = _request_token()
+                except RuntimeError as e:
+                    token_state["error"] = e
+            if "error" in token_state:
+                raise token_state["error"]
+            return token_state["token"]
+
+    def fetch(date8):
+        """Return (date8, best trains, error message or None)."""
+        api_date = f"{date8[:4]}-{date8[4:6]}-{date8[6:]}"
+        try:
+            data = _cached_timetable(get_token, origin_id, dest_id, api_date)
+            return date8, _best_trains(data, origin_id, dest_id, lo, hi, types, sort, top), None
+        except Exception as e:
+            print(f"{api_date} 查詢失敗: {e}", file=sys.stderr)
+            return date8, [], str(e)
+
+    def day_records(d, best, error):
+        date = f"{d[:4]}-{d[4:6]}-{d[6:]}"
+        if error:
+            failed.append(date)
+            yield {"date": date, "error": error}
+        for rank, t in enumerate(best, 1):
+            yield {"date": date, "rank": rank, **_to_record(t)}
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=min(RANGE_MAX_WORKERS, len(dates))) as pool:
+        # map() keeps date order, so each day is emitted as soon as it and
+        # all earlier days are done
+        results = pool.map(fetch, dates)
+
+        if fmt != "table":
+            write_records(
+                (r for day in results for r in day_records(*day)),
+                fmt,
+                fields=RANGE_RECORD_FIELDS,
+            )
+        else:
+            sort_label = "最快" if sort == "duration" else "最早抵達"
+            print(f"\n查詢: {origin_name} → {dest_name} | {start8[:4]}/{start8[4:6]}/{start8[6:]}"
+                  f" ~ {end8[:4]}/{end8[4:6]}/{end8[6:]} {time_from}-{time_to} 出發，每天{sort_label} {top} 班\n")
+            _print_table_header(prefix=f"{'日期':<10} ")
+            for d, best, error in results:
+                display_date = f"{d[:4]}/{d[4:6]}/{d[6:]}"
+                if error:
+                    failed.append(display_date)
+                    print(f"{display_date:<12} 查詢失敗")
+                elif not best:
+                    print(f"{display_date:<12} 查無資料")
+                for t in best:
+                    print(f"{display_date:<12} {_table_row(t)}")
+            print()
+
+    if failed:
+        print(f"錯誤：{len(failed)} 天查詢失敗：{', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)